@@ -4,15 +4,15 @@
 
 """ Unit tests for zeroconf.py """
 
-import copy
 import logging
+import os
 import socket
 import struct
+import threading
 import time
 import unittest
-from threading import Event
+from threading import Condition, Event
 
-from six import indexbytes
 from six.moves import xrange
 
 import zeroconf as r
@@ -29,6 +29,47 @@ from zeroconf import (
 log = logging.getLogger("zeroconf")
 original_logging_level = [None]
 
+# address and host the test services are registered with
+_TEST_ADDRESS = socket.inet_aton("10.0.1.2")
+_TEST_SERVER = "ash-2.local."
+# TXT record of the test services, already in wire format
+_TEST_TEXT = b"\x0epath=/~paulsm/"
+
+# service the integration tests register and browse for
+_HTTP_TYPE = "_http._tcp.local."
+_HTTP_REGISTRATION_NAME = "xxxyyy.%s" % _HTTP_TYPE
+
+
+_STRUCT_BYTE = struct.Struct("!B")
+
+
+def _skip_name(packet, offset):
+    """Returns the offset just past the encoded name starting at offset"""
+    while True:
+        (length,) = _STRUCT_BYTE.unpack_from(packet, offset)
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            # a compression pointer ends the name
+            return offset + 2
+        offset += length + 1
+
+
+def _answer_ttls(packet):
+    """Returns the TTLs of all the records in a packet, reading them in
+    place without building a DNSIncoming or copying the packet"""
+    counts = r._STRUCT_HEADER.unpack_from(packet, 0)
+    offset = r._STRUCT_HEADER.size
+    for _ in xrange(counts[2]):
+        offset = _skip_name(packet, offset) + r._STRUCT_QUESTION.size
+    ttls = []
+    for _ in xrange(counts[3] + counts[4] + counts[5]):
+        offset = _skip_name(packet, offset)
+        type_, class_, ttl, length = r._STRUCT_RECORD.unpack_from(packet, offset)
+        ttls.append(ttl)
+        offset += r._STRUCT_RECORD.size + length
+    return ttls
+
 
 def setup_module():
     original_logging_level[0] = log.level
@@ -71,6 +112,31 @@ class TestDunder(unittest.TestCase):
         repr(question)
         assert not question != question
 
+    def test_dns_entry_hash_eq(self):
+        entry = r.DNSEntry("irrelevant", r._TYPE_SRV, r._CLASS_IN | r._CLASS_UNIQUE)
+        question = r.DNSQuestion("irrelevant", r._TYPE_SRV, r._CLASS_IN)
+        other = r.DNSQuestion("irrelevant", r._TYPE_TXT, r._CLASS_IN)
+        assert entry == question and hash(entry) == hash(question)
+        assert question != other
+        assert len(set([entry, question, other])) == 2
+
+    def test_dns_entry_key(self):
+        entry = r.DNSEntry("Irrelevant.Local.", r._TYPE_SRV, r._CLASS_IN)
+        assert entry.key == "irrelevant.local."
+        assert entry.name == "Irrelevant.Local."
+
+    def test_dns_record_slots(self):
+        records = (
+            r.DNSAddress("irrelevant", r._TYPE_A, r._CLASS_IN, 1, b"a"),
+            DNSHinfo("irrelevant", r._TYPE_HINFO, 0, 0, "cpu", "os"),
+            r.DNSPointer("irrelevant", r._TYPE_PTR, r._CLASS_IN, 1, "123"),
+            DNSText("irrelevant", r._TYPE_TXT, r._CLASS_IN, 1, b"123"),
+            r.DNSService("irrelevant", r._TYPE_SRV, r._CLASS_IN, 1, 0, 0, 80, "a"),
+            r.DNSQuestion("irrelevant", r._TYPE_SRV, r._CLASS_IN),
+        )
+        for record in records:
+            assert not hasattr(record, "__dict__")
+
     def test_dns_service_repr(self):
         service = r.DNSService(
             "irrelevant", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, b"a"
@@ -89,17 +155,26 @@ class TestDunder(unittest.TestCase):
         info = ServiceInfo(
             type_,
             registration_name,
-            socket.inet_aton("10.0.1.2"),
+            _TEST_ADDRESS,
             80,
             0,
             0,
             None,
-            "ash-2.local.",
+            _TEST_SERVER,
         )
 
         assert not info != info
         repr(info)
 
+    def test_service_info_text(self):
+        type_ = "_test-srvc-type._tcp.local."
+        info = ServiceInfo(type_, "xxxyyy.%s" % type_)
+        info._set_text(b"\x00\x04a=b1\x06flag=x\x04flag\x06t=true\x07f=false\x03e=")
+        self.assertEqual(
+            info.properties,
+            {b"a": b"b1", b"flag": b"x", b"t": True, b"f": False, b"e": False},
+        )
+
     def test_dns_outgoing_repr(self):
         dns_outgoing = r.DNSOutgoing(r._FLAGS_QR_QUERY)
         repr(dns_outgoing)
@@ -144,6 +219,23 @@ class PacketGeneration(unittest.TestCase):
         self.assertEqual(len(generated.answers), 1)
         self.assertEqual(len(generated.answers), len(parsed.answers))
 
+    def test_answer_ttls(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE)
+        generated.add_question(r.DNSQuestion("a.local.", r._TYPE_PTR, r._CLASS_IN))
+        generated.add_answer_at_time(
+            r.DNSPointer("a.local.", r._TYPE_PTR, r._CLASS_IN, 10, "b.a.local."), 0
+        )
+        generated.add_authorative_answer(
+            DNSText("b.a.local.", r._TYPE_TXT, r._CLASS_IN, 20, b"\x01a")
+        )
+        generated.add_additional_answer(
+            r.DNSAddress("b.local.", r._TYPE_A, r._CLASS_IN, 30, b"abcd")
+        )
+        packet = generated.packet()
+        parsed = r.DNSIncoming(packet)
+        assert _answer_ttls(packet) == [answer.ttl for answer in parsed.answers]
+        assert _answer_ttls(packet) == [10, 20, 30]
+
     def test_match_question(self):
         generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
         question = r.DNSQuestion("testname.local.", r._TYPE_SRV, r._CLASS_IN)
@@ -154,39 +246,15 @@ class PacketGeneration(unittest.TestCase):
         self.assertEqual(question, parsed.questions[0])
 
     def test_suppress_answer(self):
+        def service(name, type_=r._TYPE_SRV, class_=r._CLASS_IN, ttl=r._DNS_TTL):
+            return r.DNSService(name, type_, class_, ttl, 0, 0, 80, "foo.local.")
+
         query_generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
         question = r.DNSQuestion("testname.local.", r._TYPE_SRV, r._CLASS_IN)
         query_generated.add_question(question)
-        answer1 = r.DNSService(
-            "testname1.local.",
-            r._TYPE_SRV,
-            r._CLASS_IN,
-            r._DNS_TTL,
-            0,
-            0,
-            80,
-            "foo.local.",
-        )
-        staleanswer2 = r.DNSService(
-            "testname2.local.",
-            r._TYPE_SRV,
-            r._CLASS_IN,
-            r._DNS_TTL / 2,
-            0,
-            0,
-            80,
-            "foo.local.",
-        )
-        answer2 = r.DNSService(
-            "testname2.local.",
-            r._TYPE_SRV,
-            r._CLASS_IN,
-            r._DNS_TTL,
-            0,
-            0,
-            80,
-            "foo.local.",
-        )
+        answer1 = service("testname1.local.")
+        staleanswer2 = service("testname2.local.", ttl=r._DNS_TTL / 2)
+        answer2 = service("testname2.local.")
         query_generated.add_answer_at_time(answer1, 0)
         query_generated.add_answer_at_time(staleanswer2, 0)
         query = r.DNSIncoming(query_generated.packet())
@@ -201,21 +269,15 @@ class PacketGeneration(unittest.TestCase):
         assert len(response.answers) == 1
 
         # Should not be suppressed, name is different
-        tmp = copy.copy(answer1)
-        tmp.name = "testname3.local."
-        response.add_answer(query, tmp)
+        response.add_answer(query, service("testname3.local."))
         assert len(response.answers) == 2
 
         # Should not be suppressed, type is different
-        tmp = copy.copy(answer1)
-        tmp.type = r._TYPE_A
-        response.add_answer(query, tmp)
+        response.add_answer(query, service("testname1.local.", type_=r._TYPE_A))
         assert len(response.answers) == 3
 
         # Should not be suppressed, class is different
-        tmp = copy.copy(answer1)
-        tmp.class_ = r._CLASS_NONE
-        response.add_answer(query, tmp)
+        response.add_answer(query, service("testname1.local.", class_=r._CLASS_NONE))
         assert len(response.answers) == 4
 
         # ::TODO:: could add additional tests for DNSAddress, DNSHinfo, DNSPointer, DNSText, DNSService
@@ -241,19 +303,19 @@ class PacketForm(unittest.TestCase):
         """ID must be zero in a DNS-SD packet"""
         generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
         bytes = generated.packet()
-        id = indexbytes(bytes, 0) << 8 | indexbytes(bytes, 1)
+        (id,) = struct.unpack_from("!H", bytes, 0)
         self.assertEqual(id, 0)
 
     def test_query_header_bits(self):
         generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
         bytes = generated.packet()
-        flags = indexbytes(bytes, 2) << 8 | indexbytes(bytes, 3)
+        (flags,) = struct.unpack_from("!H", bytes, 2)
         self.assertEqual(flags, 0x0)
 
     def test_response_header_bits(self):
         generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE)
         bytes = generated.packet()
-        flags = indexbytes(bytes, 2) << 8 | indexbytes(bytes, 3)
+        (flags,) = struct.unpack_from("!H", bytes, 2)
         self.assertEqual(flags, 0x8000)
 
     def test_numbers(self):
@@ -315,6 +377,35 @@ class Names(unittest.TestCase):
         generated.add_question(question)
         r.DNSIncoming(generated.packet())
 
+    def test_name_compression(self):
+        names = (
+            "a.shared.local.",
+            "b.shared.local.",
+            "shared.local.",
+            "a.other.local.",
+            "a.shared.local.",
+            u"æ.local",
+        )
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE)
+        for name in names:
+            generated.add_question(r.DNSQuestion(name, r._TYPE_SRV, r._CLASS_IN))
+        packet = generated.packet()
+        parsed = r.DNSIncoming(packet)
+        self.assertEqual(
+            [q.name for q in parsed.questions],
+            [
+                "a.shared.local.",
+                "b.shared.local.",
+                "shared.local.",
+                "a.other.local.",
+                "a.shared.local.",
+                u"æ.local.",
+            ],
+        )
+        # the repeated name is a single pointer to its first occurrence
+        assert packet.count(b"\x06shared") == 1
+        assert packet.count(b"\x05other") == 1
+
     def test_lots_of_names(self):
 
         # instantiate a zeroconf instance
@@ -334,6 +425,7 @@ class Names(unittest.TestCase):
 
         # needs to be a list so that we can modify it in our phony send
         longest_packet = [0, None]
+        longest_packet_maxed_out = Event()
 
         def send(out, addr=r._MDNS_ADDR, port=r._MDNS_PORT):
             """Sends an outgoing packet."""
@@ -341,6 +433,8 @@ class Names(unittest.TestCase):
             if longest_packet[0] < len(packet):
                 longest_packet[0] = len(packet)
                 longest_packet[1] = out
+                if len(packet) >= r._MAX_MSG_ABSOLUTE - 100:
+                    longest_packet_maxed_out.set()
             old_send(out, addr=addr, port=port)
 
         # monkey patch the zeroconf send
@@ -354,17 +448,14 @@ class Names(unittest.TestCase):
         browser = ServiceBrowser(zc, type_, [on_service_state_change])
 
         # wait until the browse request packet has maxed out in size
-        sleep_count = 0
-        while sleep_count < 100 and longest_packet[0] < r._MAX_MSG_ABSOLUTE - 100:
-            sleep_count += 1
-            time.sleep(0.1)
+        longest_packet_maxed_out.wait(10)
 
         browser.cancel()
         time.sleep(0.5)
 
         import zeroconf
 
-        zeroconf.log.debug("sleep_count %d, sized %d", sleep_count, longest_packet[0])
+        zeroconf.log.debug("sized %d", longest_packet[0])
 
         # now the browser has sent at least one request, verify the size
         assert longest_packet[0] <= r._MAX_MSG_ABSOLUTE
@@ -443,16 +534,15 @@ class Names(unittest.TestCase):
         mocked_log_debug.stop()
 
     def verify_name_change(self, zc, type_, name, number_hosts):
-        desc = {"path": "/~paulsm/"}
         info_service = ServiceInfo(
             type_,
             "%s.%s" % (name, type_),
-            socket.inet_aton("10.0.1.2"),
+            _TEST_ADDRESS,
             80,
             0,
             0,
-            desc,
-            "ash-2.local.",
+            _TEST_TEXT,
+            _TEST_SERVER,
         )
 
         # verify name conflict
@@ -465,28 +555,32 @@ class Names(unittest.TestCase):
         records_per_server = 2
         block_size = 25
         number_hosts = int(((number_hosts - 1) / block_size + 1)) * block_size
+        # each block of hosts fits comfortably in a single packet, and there
+        # are few enough of them to send them all before waiting for them
+        out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
         for i in range(1, number_hosts + 1):
             next_name = name if i == 1 else "%s-%d" % (name, i)
-            self.generate_host(zc, next_name, type_)
+            self.generate_host(out, next_name, type_)
             if i % block_size == 0:
-                sleep_count = 0
-                while sleep_count < 40 and i * records_per_server > len(
-                    zc.cache.entries_with_name(type_)
-                ):
-                    sleep_count += 1
-                    time.sleep(0.05)
+                zc.send(out)
+                out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+
+        sleep_count = 0
+        while sleep_count < 100 and number_hosts * records_per_server > len(
+            zc.cache.entries_with_name(type_)
+        ):
+            sleep_count += 1
+            time.sleep(0.05)
 
     @staticmethod
-    def generate_host(zc, host_name, type_):
+    def generate_host(out, host_name, type_):
         name = ".".join((host_name, type_))
-        out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
         out.add_answer_at_time(
             r.DNSPointer(type_, r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, name), 0
         )
         out.add_answer_at_time(
             r.DNSService(type_, r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, name), 0
         )
-        zc.send(out)
 
 
 class Framework(unittest.TestCase):
@@ -496,6 +590,80 @@ class Framework(unittest.TestCase):
         rv = r.Zeroconf(interfaces=r.InterfaceChoice.Default)
         rv.close()
 
+    def test_engine_honours_done_wait_time(self):
+        from mock import patch
+
+        waited = Event()
+
+        def done(zc):
+            if threading.current_thread().name == "zeroconf-Engine":
+                waited.set()
+            return zc._GLOBAL_DONE.wait(r.get_global_done_wait_time())
+
+        with patch.dict(os.environ, {"PYTHON_ZEROCONF_GLOBAL_DONE_WAIT_TIME": "0.01"}):
+            with patch.object(r.Zeroconf, "done", property(done)):
+                zc = Zeroconf(interfaces=["127.0.0.1"])
+                zc.close()
+        assert waited.is_set()
+
+    @unittest.skipIf(not r._MSG_DONTWAIT, "needs MSG_DONTWAIT")
+    def test_listener_drains_queued_packets(self):
+        responses = []
+
+        class FakeZeroconf(object):
+            def handle_response(self, msg):
+                responses.append(msg)
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(("127.0.0.1", 0))
+            packet = r.DNSOutgoing(r._FLAGS_QR_RESPONSE).packet()
+            for _ in xrange(3):
+                sender.sendto(packet, receiver.getsockname())
+            time.sleep(0.1)
+
+            r.Listener(FakeZeroconf()).handle_read(receiver)
+            assert len(responses) == 3
+        finally:
+            sender.close()
+            receiver.close()
+
+    def test_reaper_waits_for_its_interval(self):
+        zc = Zeroconf(interfaces=["127.0.0.1"])
+        time_offset_millis = [0]
+        original_current_time_millis = r.current_time_millis
+        r.current_time_millis = lambda: (
+            original_current_time_millis() + time_offset_millis[0]
+        )
+        try:
+            record = r.DNSAddress("a.local.", r._TYPE_A, r._CLASS_IN, 1, b"abcd")
+            zc.cache.add(record)
+
+            # expired, but being woken up is not enough to reap it early
+            time_offset_millis[0] = 2 * 1000
+            zc.notify_all()
+            time.sleep(0.1)
+            assert zc.cache.get(record) is not None
+
+            time_offset_millis[0] = r._REAPER_INTERVAL + 1000
+            zc.notify_all()
+            time.sleep(0.1)
+            assert zc.cache.get(record) is None
+
+            # a clock stepping backwards must not hold off reaping until
+            # it has caught up again
+            time_offset_millis[0] = -3600 * 1000
+            record = r.DNSAddress("b.local.", r._TYPE_A, r._CLASS_IN, 1, b"abcd")
+            zc.cache.add(record)
+            time_offset_millis[0] += 12 * 1000
+            zc.notify_all()
+            time.sleep(0.1)
+            assert zc.cache.get(record) is None
+        finally:
+            r.current_time_millis = original_current_time_millis
+            zc.close()
+
 
 class Exceptions(unittest.TestCase):
 
@@ -554,6 +722,7 @@ class Exceptions(unittest.TestCase):
             "._x._tcp.local.",
             "a" * 64 + "._sub._http._tcp.local.",
             "a" * 62 + u"â._sub._http._tcp.local.",
+            "_x\n._tcp.local.",
         )
         for name in bad_names_to_try:
             self.assertRaises(r.BadTypeInNameException, r.service_type_name, name)
@@ -616,16 +785,15 @@ class TestRegistrar(unittest.TestCase):
         name = "xxxyyy"
         registration_name = "%s.%s" % (name, type_)
 
-        desc = {"path": "/~paulsm/"}
         info = ServiceInfo(
             type_,
             registration_name,
-            socket.inet_aton("10.0.1.2"),
+            _TEST_ADDRESS,
             80,
             0,
             0,
-            desc,
-            "ash-2.local.",
+            _TEST_TEXT,
+            _TEST_SERVER,
         )
 
         # we are going to monkey patch the zeroconf send to check packet sizes
@@ -709,6 +877,34 @@ class TestRegistrar(unittest.TestCase):
         )
         nbr_answers[0] = nbr_additionals[0] = nbr_authorities[0] = 0
 
+    def test_update_service_answers(self):
+        zc = Zeroconf(interfaces=["127.0.0.1"])
+        type_ = "_test-srvc-type._tcp.local."
+        registration_name = "xxxyyy.%s" % type_
+        info = ServiceInfo(
+            type_, registration_name, _TEST_ADDRESS, 80, 0, 0, {}, _TEST_SERVER
+        )
+        zc.register_service(info)
+
+        sent = []
+        zc.send = lambda out, addr=None, port=None, interface=None: sent.append(out)
+
+        def query_srv():
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion(info.name, r._TYPE_SRV, r._CLASS_IN))
+            zc.handle_query(query, r._MDNS_ADDR, r._MDNS_PORT)
+            (answer, time_), = sent.pop().answers
+            return answer
+
+        assert query_srv().port == 80
+        info.port = 8080
+        zc.update_service(info)
+        assert query_srv().port == 8080
+
+        zc.unregister_service(info)
+        assert not zc._service_answers
+        zc.close()
+
 
 class TestDNSCache(unittest.TestCase):
     def test_order(self):
@@ -721,25 +917,51 @@ class TestDNSCache(unittest.TestCase):
         cached_record = cache.get(entry)
         self.assertEqual(cached_record, record2)
 
+    def test_entries(self):
+        cache = r.DNSCache()
+        self.assertEqual(cache.entries(), [])
+        records = [
+            r.DNSAddress("a", r._TYPE_SOA, r._CLASS_IN, 1, b"a"),
+            r.DNSAddress("A", r._TYPE_SOA, r._CLASS_IN, 1, b"b"),
+            r.DNSAddress("b", r._TYPE_SOA, r._CLASS_IN, 1, b"c"),
+        ]
+        for record in records:
+            cache.add(record)
+        self.assertEqual(len(cache.entries()), 3)
+        self.assertEqual(len(cache.entries_with_name("a")), 2)
+        for record in records:
+            assert record in cache.entries()
+
 
 class ServiceTypesQuery(unittest.TestCase):
+
+    registrar = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.registrar = Zeroconf(interfaces=["127.0.0.1"])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.registrar.close()
+        cls.registrar = None
+
     def test_integration_with_listener(self):
 
         type_ = "_test-srvc-type._tcp.local."
         name = "xxxyyy"
         registration_name = "%s.%s" % (name, type_)
 
-        zeroconf_registrar = Zeroconf(interfaces=["127.0.0.1"])
-        desc = {"path": "/~paulsm/"}
+        zeroconf_registrar = self.registrar
         info = ServiceInfo(
             type_,
             registration_name,
-            socket.inet_aton("10.0.1.2"),
+            _TEST_ADDRESS,
             80,
             0,
             0,
-            desc,
-            "ash-2.local.",
+            _TEST_TEXT,
+            _TEST_SERVER,
         )
         zeroconf_registrar.register_service(info)
 
@@ -754,7 +976,7 @@ class ServiceTypesQuery(unittest.TestCase):
             assert type_ in service_types
 
         finally:
-            zeroconf_registrar.close()
+            zeroconf_registrar.unregister_service(info)
 
     def test_integration_with_subtype_and_listener(self):
         subtype_ = "_subtype._sub"
@@ -764,17 +986,16 @@ class ServiceTypesQuery(unittest.TestCase):
         discovery_type = "%s.%s" % (subtype_, type_)
         registration_name = "%s.%s" % (name, type_)
 
-        zeroconf_registrar = Zeroconf(interfaces=["127.0.0.1"])
-        desc = {"path": "/~paulsm/"}
+        zeroconf_registrar = self.registrar
         info = ServiceInfo(
             discovery_type,
             registration_name,
-            socket.inet_aton("10.0.1.2"),
+            _TEST_ADDRESS,
             80,
             0,
             0,
-            desc,
-            "ash-2.local.",
+            _TEST_TEXT,
+            _TEST_SERVER,
         )
         zeroconf_registrar.register_service(info)
 
@@ -789,7 +1010,7 @@ class ServiceTypesQuery(unittest.TestCase):
             assert discovery_type in service_types
 
         finally:
-            zeroconf_registrar.close()
+            zeroconf_registrar.unregister_service(info)
 
 
 class ListenerTest(unittest.TestCase):
@@ -842,12 +1063,12 @@ class ListenerTest(unittest.TestCase):
         info_service = ServiceInfo(
             subtype,
             registration_name,
-            socket.inet_aton("10.0.1.2"),
+            _TEST_ADDRESS,
             80,
             0,
             0,
             desc,
-            "ash-2.local.",
+            _TEST_SERVER,
         )
         zeroconf_registrar.register_service(info_service)
 
@@ -883,12 +1104,12 @@ class ListenerTest(unittest.TestCase):
             info_service = ServiceInfo(
                 subtype,
                 registration_name,
-                socket.inet_aton("10.0.1.2"),
+                _TEST_ADDRESS,
                 80,
                 0,
                 0,
                 desc,
-                "ash-2.local.",
+                _TEST_SERVER,
             )
             zeroconf_registrar.update_service(info_service)
             service_updated.wait(2)
@@ -927,32 +1148,22 @@ def _init_zeroconf_browser(service_type, registration_name):
 
 
 def test_add_remove_interfaces_integration():
-    type_ = "_http._tcp.local."
-    registration_name = "xxxyyy.%s" % type_
-
-    zeroconf_browser, service_added, service_removed = _init_zeroconf_browser(type_, registration_name)
+    zeroconf_browser, service_added, service_removed = _init_zeroconf_browser(
+        _HTTP_TYPE, _HTTP_REGISTRATION_NAME
+    )
 
     expected_ttl = r._DNS_TTL
-    time_offset = 0
-
-    def current_time_millis():
-        """Current system time in milliseconds"""
-        return time.time() * 1000 + time_offset * 1000
-
-    # monkey patch the zeroconf current_time_millis
-    r.current_time_millis = current_time_millis
 
     zeroconf_registrar = Zeroconf(interfaces=[])
-    desc = {"path": "/~paulsm/"}
     info = ServiceInfo(
-        type_,
-        registration_name,
-        socket.inet_aton("10.0.1.2"),
+        _HTTP_TYPE,
+        _HTTP_REGISTRATION_NAME,
+        _TEST_ADDRESS,
         80,
         0,
         0,
-        desc,
-        "ash-2.local.",
+        _TEST_TEXT,
+        _TEST_SERVER,
     )
     zeroconf_registrar.register_service(info)
 
@@ -980,58 +1191,81 @@ def test_add_remove_interfaces_integration():
         zeroconf_browser.close()
 
 
+def test_service_info_request_known_answers():
+    zc = Zeroconf(interfaces=["127.0.0.1"])
+    info = ServiceInfo(_HTTP_TYPE, _HTTP_REGISTRATION_NAME)
+    now = r.current_time_millis()
+
+    stale = r.DNSService(
+        info.name, r._TYPE_SRV, r._CLASS_IN, 10, 0, 0, 80, _TEST_SERVER
+    )
+    # past half of its 10 second TTL, but not expired yet
+    stale.created = now - 6 * 1000
+    fresh = DNSText(info.name, r._TYPE_TXT, r._CLASS_IN, 10, b"\x04a=bc")
+    zc.cache.add(stale)
+    zc.cache.add(fresh)
+
+    sent = []
+    zc.send = lambda out, addr=None, port=None, interface=None: sent.append(out)
+    try:
+        assert not info.request(zc, 300)
+        assert [answer for answer, time_ in sent[0].answers] == [fresh]
+    finally:
+        zc.close()
+
+
 def test_integration():
     unexpected_ttl = Event()
-    got_query = Event()
+    got_query = Condition()
 
-    type_ = "_http._tcp.local."
-    registration_name = "xxxyyy.%s" % type_
-
-    zeroconf_browser, service_added, service_removed = _init_zeroconf_browser(type_, registration_name)
+    zeroconf_browser, service_added, service_removed = _init_zeroconf_browser(
+        _HTTP_TYPE, _HTTP_REGISTRATION_NAME
+    )
 
     # we are going to monkey patch the zeroconf send to check packet sizes
     old_send = zeroconf_browser.send
 
-    time_offset = 0
+    time_offset_millis = 0
 
     def current_time_millis():
         """Current system time in milliseconds"""
-        return time.time() * 1000 + time_offset * 1000
+        return time.time() * 1000 + time_offset_millis
 
     expected_ttl = r._DNS_TTL
+    # known answers have to have more than half their TTL left
+    half_ttl = expected_ttl / 2
 
     # needs to be a list so that we can modify it in our phony send
     nbr_queries = [0, None]
 
     def send(out, addr=r._MDNS_ADDR, port=r._MDNS_PORT, interface=None):
         """Sends an outgoing packet."""
-        pout = r.DNSIncoming(out.packet())
+        ttls = _answer_ttls(out.packet())
+        if ttls and not min(ttls) > half_ttl:
+            unexpected_ttl.set()
 
-        for answer in pout.answers:
-            nbr_queries[0] += 1
-            if not answer.ttl > expected_ttl / 2:
-                unexpected_ttl.set()
-
-        got_query.set()
+        with got_query:
+            nbr_queries[0] += len(ttls)
+            got_query.notify()
         old_send(out, addr=addr, port=port, interface=interface)
 
     # monkey patch the zeroconf send
     zeroconf_browser.send = send
 
     # monkey patch the zeroconf current_time_millis
+    original_current_time_millis = r.current_time_millis
     r.current_time_millis = current_time_millis
 
     zeroconf_registrar = Zeroconf(interfaces=["127.0.0.1"])
-    desc = {"path": "/~paulsm/"}
     info = ServiceInfo(
-        type_,
-        registration_name,
-        socket.inet_aton("10.0.1.2"),
+        _HTTP_TYPE,
+        _HTTP_REGISTRATION_NAME,
+        _TEST_ADDRESS,
         80,
         0,
         0,
-        desc,
-        "ash-2.local.",
+        _TEST_TEXT,
+        _TEST_SERVER,
     )
     zeroconf_registrar.register_service(info)
 
@@ -1040,17 +1274,21 @@ def test_integration():
         assert service_added.is_set()
 
         sleep_count = 0
-        while nbr_queries[0] < 50:
-            time_offset += expected_ttl / 4
-            zeroconf_browser.notify_all()
-            sleep_count += 1
-            got_query.wait(1)
-            got_query.clear()
+        # the lock is only released while waiting, so a query sent in
+        # response to notify_all() cannot slip in before the wait
+        with got_query:
+            while nbr_queries[0] < 50:
+                # a quarter of the TTL, which is in seconds
+                time_offset_millis += expected_ttl * 250
+                zeroconf_browser.notify_all()
+                sleep_count += 1
+                got_query.wait(1)
         assert not unexpected_ttl.is_set()
 
         # Don't remove service, allow close() to cleanup
 
     finally:
+        r.current_time_millis = original_current_time_millis
         zeroconf_registrar.close()
         service_removed.wait(1)
         assert service_removed.is_set()
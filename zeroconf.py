@@ -32,7 +32,8 @@ import struct
 import sys
 import threading
 import time
-from functools import reduce
+from collections import deque
+from itertools import chain
 
 # Use ifaddr instead of ifcfg in order to ensure that we are always
 # able to read outgoing addresses. ifcfg fails to do so on Windows
@@ -79,17 +80,24 @@ _CHECK_TIME = 175
 _REGISTER_TIME = 225
 _LISTENER_TIME = 200
 _BROWSER_TIME = 500
+_REAPER_INTERVAL = 10 * 1000
 
 # Some DNS constants
 
 _MDNS_ADDR = "224.0.0.251"
 _MDNS_PORT = 5353
+_MDNS_ADDR_BYTES = socket.inet_aton(_MDNS_ADDR)
 _DNS_PORT = 53
 _DNS_TTL = 120  # two minutes default TTL as recommended by RFC6762
 
 _MAX_MSG_TYPICAL = 1460  # unused
 _MAX_MSG_ABSOLUTE = 8966
 
+# packets read from a socket for each time select reports it readable,
+# the ones after the first only if they are already queued
+_MAX_READS_PER_WAKEUP = 16
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)  # not on Windows
+
 _FLAGS_QR_MASK = 0x8000  # query response mask
 _FLAGS_QR_QUERY = 0x0000  # query
 _FLAGS_QR_RESPONSE = 0x8000  # response
@@ -165,8 +173,19 @@ _TYPES = {
     _TYPE_ANY: "any",
 }
 
+# Precompiled wire formats
+
+_STRUCT_HEADER = struct.Struct(b"!6H")
+_STRUCT_QUESTION = struct.Struct(b"!HH")
+_STRUCT_RECORD = struct.Struct(b"!HHiH")
+_STRUCT_SHORT = struct.Struct(b"!H")
+_STRUCT_INT = struct.Struct(b"!I")
+
+_LOCAL_TRAILERS = ("._tcp.local.", "._udp.local.")
+_LOCAL_TRAILER_LENGTH = len("._tcp.local.")
+
 _HAS_A_TO_Z = re.compile(r"[A-Za-z]")
-_HAS_ONLY_A_TO_Z_NUM_HYPHEN = re.compile(r"^[A-Za-z0-9\-]+$")
+_HAS_ONLY_A_TO_Z_NUM_HYPHEN = re.compile(r"[A-Za-z0-9\-]+\Z")
 _HAS_ASCII_CONTROL_CHARS = re.compile(r"[\x00-\x1f\x7f]")
 
 
@@ -235,12 +254,12 @@ def service_type_name(type_):
     :param type_: Type, SubType or service name to validate
     :return: fully qualified service name (eg: _http._tcp.local.)
     """
-    if not (type_.endswith("._tcp.local.") or type_.endswith("._udp.local.")):
+    if not type_.endswith(_LOCAL_TRAILERS):
         raise BadTypeInNameException(
             "Type '%s' must end with '._tcp.local.' or '._udp.local.'" % type_
         )
 
-    remaining = type_[: -len("._tcp.local.")].split(".")
+    remaining = type_[:-_LOCAL_TRAILER_LENGTH].split(".")
     name = remaining.pop()
     if not name:
         raise BadTypeInNameException("No Service name found")
@@ -270,7 +289,7 @@ def service_type_name(type_):
             "Service name (%s) must contain at least one letter (eg: 'A-Z')" % name
         )
 
-    if not _HAS_ONLY_A_TO_Z_NUM_HYPHEN.search(name):
+    if not _HAS_ONLY_A_TO_Z_NUM_HYPHEN.match(name):
         raise BadTypeInNameException(
             "Service name (%s) must contain only these characters: "
             "A-Z, a-z, 0-9, hyphen ('-')" % name
@@ -295,7 +314,7 @@ def service_type_name(type_):
                 % remaining[0]
             )
 
-    return "_" + name + type_[-len("._tcp.local.") :]
+    return "_" + name + type_[-_LOCAL_TRAILER_LENGTH:]
 
 
 # Exceptions
@@ -361,26 +380,38 @@ class DNSEntry(object):
 
     """A DNS entry"""
 
+    __slots__ = ("name", "type", "class_", "unique", "_key", "_eq_key", "_hash")
+
     def __init__(self, name, type_, class_):
-        self.key = name.lower()
+        self._key = None
         self.name = name
         self.type = type_
         self.class_ = class_ & _CLASS_MASK
         self.unique = (class_ & _CLASS_UNIQUE) != 0
+        # entries are compared and hashed on name, type and class far more
+        # often than they are built, so the key and its hash are kept around
+        self._eq_key = (name, type_, self.class_)
+        self._hash = hash(self._eq_key)
+
+    @property
+    def key(self):
+        """Lowercased name, only needed for entries that go in the cache"""
+        if self._key is None:
+            self._key = self.name.lower()
+        return self._key
 
     def __eq__(self, other):
         """Equality test on name, type, and class"""
-        return (
-            isinstance(other, DNSEntry)
-            and self.name == other.name
-            and self.type == other.type
-            and self.class_ == other.class_
-        )
+        return isinstance(other, DNSEntry) and self._eq_key == other._eq_key
 
     def __ne__(self, other):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    def __hash__(self):
+        """Hash on name, type, and class"""
+        return self._hash
+
     @staticmethod
     def get_class_(class_):
         """Class accessor"""
@@ -414,6 +445,8 @@ class DNSQuestion(DNSEntry):
 
     """A DNS question entry"""
 
+    __slots__ = ()
+
     def __init__(self, name, type_, class_):
         DNSEntry.__init__(self, name, type_, class_)
 
@@ -434,6 +467,8 @@ class DNSRecord(DNSEntry):
 
     """A DNS record - like a DNS entry, but has a TTL"""
 
+    __slots__ = ("ttl", "created")
+
     def __init__(self, name, type_, class_, ttl):
         DNSEntry.__init__(self, name, type_, class_)
         self.ttl = ttl
@@ -447,6 +482,8 @@ class DNSRecord(DNSEntry):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSEntry.__hash__
+
     def suppressed_by(self, msg):
         """Returns true if any answer in a message can suffice for the
         information held in this record."""
@@ -458,7 +495,13 @@ class DNSRecord(DNSEntry):
     def suppressed_by_answer(self, other):
         """Returns true if another record has same name, type and class,
         and if its TTL is at least half of this record's."""
-        return self == other and other.ttl > (self.ttl / 2)
+        # the cached hashes differ for most unrelated records, which rules
+        # them out before the full (rdata comparing) equality test
+        return (
+            self._hash == other._hash
+            and other.ttl > (self.ttl / 2)
+            and self == other
+        )
 
     def get_expiration_time(self, percent):
         """Returns the time at which this record will have expired
@@ -501,6 +544,8 @@ class DNSAddress(DNSRecord):
 
     """A DNS address record"""
 
+    __slots__ = ("address",)
+
     def __init__(self, name, type_, class_, ttl, address):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         self.address = address
@@ -521,6 +566,8 @@ class DNSAddress(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSEntry.__hash__
+
     def __repr__(self):
         """String representation"""
         try:
@@ -533,6 +580,8 @@ class DNSHinfo(DNSRecord):
 
     """A DNS host information record"""
 
+    __slots__ = ("cpu", "os")
+
     def __init__(self, name, type_, class_, ttl, cpu, os):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         try:
@@ -562,6 +611,8 @@ class DNSHinfo(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSEntry.__hash__
+
     def __repr__(self):
         """String representation"""
         return self.cpu + " " + self.os
@@ -571,6 +622,8 @@ class DNSPointer(DNSRecord):
 
     """A DNS pointer record"""
 
+    __slots__ = ("alias",)
+
     def __init__(self, name, type_, class_, ttl, alias):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         self.alias = alias
@@ -591,6 +644,8 @@ class DNSPointer(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSEntry.__hash__
+
     def __repr__(self):
         """String representation"""
         return self.to_string(self.alias)
@@ -600,6 +655,8 @@ class DNSText(DNSRecord):
 
     """A DNS text record"""
 
+    __slots__ = ("text",)
+
     def __init__(self, name, type_, class_, ttl, text):
         assert isinstance(text, (bytes, type(None)))
         DNSRecord.__init__(self, name, type_, class_, ttl)
@@ -621,6 +678,8 @@ class DNSText(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSEntry.__hash__
+
     def __repr__(self):
         """String representation"""
         if len(self.text) > 10:
@@ -633,6 +692,8 @@ class DNSService(DNSRecord):
 
     """A DNS service record"""
 
+    __slots__ = ("priority", "weight", "port", "server")
+
     def __init__(self, name, type_, class_, ttl, priority, weight, port, server):
         DNSRecord.__init__(self, name, type_, class_, ttl)
         self.priority = priority
@@ -662,6 +723,8 @@ class DNSService(DNSRecord):
         """Non-equality test"""
         return not self.__eq__(other)
 
+    __hash__ = DNSEntry.__hash__
+
     def __repr__(self):
         """String representation"""
         return self.to_string("%s:%s" % (self.server, self.port))
@@ -696,10 +759,10 @@ class DNSIncoming(QuietLogger):
                 ("Choked at offset %d while unpacking %r", self.offset, data)
             )
 
-    def unpack(self, format_):
-        length = struct.calcsize(format_)
-        info = struct.unpack(format_, self.data[self.offset : self.offset + length])
-        self.offset += length
+    def unpack(self, struct_):
+        """Unpacks a precompiled struct at the current offset"""
+        info = struct_.unpack_from(self.data, self.offset)
+        self.offset += struct_.size
         return info
 
     def read_header(self):
@@ -711,13 +774,13 @@ class DNSIncoming(QuietLogger):
             self.num_answers,
             self.num_authorities,
             self.num_additionals,
-        ) = self.unpack(b"!6H")
+        ) = self.unpack(_STRUCT_HEADER)
 
     def read_questions(self):
         """Reads questions section of packet"""
         for i in xrange(self.num_questions):
             name = self.read_name()
-            type_, class_ = self.unpack(b"!HH")
+            type_, class_ = self.unpack(_STRUCT_QUESTION)
 
             question = DNSQuestion(name, type_, class_)
             self.questions.append(question)
@@ -740,7 +803,7 @@ class DNSIncoming(QuietLogger):
 
     def read_unsigned_short(self):
         """Reads an unsigned short from the packet"""
-        return self.unpack(b"!H")[0]
+        return self.unpack(_STRUCT_SHORT)[0]
 
     def read_others(self):
         """Reads the answers, authorities and additionals section of the
@@ -748,7 +811,7 @@ class DNSIncoming(QuietLogger):
         n = self.num_answers + self.num_authorities + self.num_additionals
         for i in xrange(n):
             domain = self.read_name()
-            type_, class_, ttl, length = self.unpack(b"!HHiH")
+            type_, class_, ttl, length = self.unpack(_STRUCT_RECORD)
 
             rec = None
             if type_ == _TYPE_A:
@@ -934,20 +997,23 @@ class DNSOutgoing(object):
 
     def write_byte(self, value):
         """Writes a single byte to the packet"""
-        self.pack(b"!c", int2byte(value))
+        self.data.append(int2byte(value))
+        self.size += 1
 
     def insert_short(self, index, value):
         """Inserts an unsigned short in a certain position in the packet"""
-        self.data.insert(index, struct.pack(b"!H", value))
+        self.data.insert(index, _STRUCT_SHORT.pack(value))
         self.size += 2
 
     def write_short(self, value):
         """Writes an unsigned short to the packet"""
-        self.pack(b"!H", value)
+        self.data.append(_STRUCT_SHORT.pack(value))
+        self.size += 2
 
     def write_int(self, value):
         """Writes an unsigned integer to the packet"""
-        self.pack(b"!I", int(value))
+        self.data.append(_STRUCT_INT.pack(int(value)))
+        self.size += 4
 
     def write_string(self, value):
         """Writes a string to the packet"""
@@ -990,33 +1056,39 @@ class DNSOutgoing(object):
         if not parts[-1]:
             parts.pop()
 
-        # construct each suffix
-        name_suffices = [".".join(parts[i:]) for i in range(len(parts))]
-
-        # look for an existing name or suffix
-        for count, sub_name in enumerate(name_suffices):
-            if sub_name in self.names:
+        # look for the longest suffix already in the packet. A suffix is
+        # keyed by its first label and the offset of the rest of the name,
+        # which keeps the lookups linear in the number of labels.
+        count = len(parts)
+        rest_offset = 0
+        while count:
+            offset = self.names.get((parts[count - 1], rest_offset))
+            if offset is None:
                 break
-        else:
-            count = len(name_suffices)
+            rest_offset = offset
+            count -= 1
 
-        # note the new names we are saving into the packet
-        name_length = len(name.encode("utf-8"))
-        for suffix in name_suffices[:count]:
-            self.names[suffix] = (
-                self.size + name_length - len(suffix.encode("utf-8")) - 1
-            )
+        # note the new names we are saving into the packet, each label
+        # starts right after the length byte and bytes of the previous one
+        offsets = []
+        offset = self.size
+        for part in parts[:count]:
+            offsets.append(offset)
+            offset += len(part.encode("utf-8")) + 1
+        for part, offset, next_offset in zip(
+            parts, offsets, offsets[1:] + [rest_offset]
+        ):
+            self.names[(part, next_offset)] = offset
 
         # write the new names out.
         for part in parts[:count]:
             self.write_utf(part)
 
         # if we wrote part of the name, create a pointer to the rest
-        if count != len(name_suffices):
+        if count != len(parts):
             # Found substring in packet, create pointer
-            index = self.names[name_suffices[count]]
-            self.write_byte((index >> 8) | 0xC0)
-            self.write_byte(index & 0xFF)
+            self.write_byte((rest_offset >> 8) | 0xC0)
+            self.write_byte(rest_offset & 0xFF)
         else:
             # this is the end of a name
             self.write_byte(0)
@@ -1083,15 +1155,17 @@ class DNSOutgoing(object):
                 overrun_additionals += self.write_record(additional, 0)
             self.state = self.State.finished
 
-            self.insert_short(0, len(self.additionals) - overrun_additionals)
-            self.insert_short(0, len(self.authorities) - overrun_authorities)
-            self.insert_short(0, len(self.answers) - overrun_answers)
-            self.insert_short(0, len(self.questions))
-            self.insert_short(0, self.flags)
-            if self.multicast:
-                self.insert_short(0, 0)
-            else:
-                self.insert_short(0, self.id)
+            self.data.insert(
+                0,
+                _STRUCT_HEADER.pack(
+                    0 if self.multicast else self.id,
+                    self.flags,
+                    len(self.questions),
+                    len(self.answers) - overrun_answers,
+                    len(self.authorities) - overrun_authorities,
+                    len(self.additionals) - overrun_additionals,
+                ),
+            )
         return b"".join(self.data)
 
 
@@ -1151,12 +1225,9 @@ class DNSCache(object):
 
     def entries(self):
         """Returns a list of all entries"""
-        if not self.cache:
-            return []
-        else:
-            # avoid size change during iteration by copying the cache
-            values = list(self.cache.values())
-            return reduce(lambda a, b: a + b, values)
+        # avoid size change during iteration by copying the cache
+        values = list(self.cache.values())
+        return list(chain.from_iterable(values))
 
 
 class Engine(threading.Thread):
@@ -1182,7 +1253,18 @@ class Engine(threading.Thread):
         self.start()
 
     def run(self):
-        while not self.zc.done:
+        # select already blocks, so by default the done event is polled
+        # without Zeroconf.done's wait, which would add a sleep to every
+        # received packet. A wait time set explicitly through
+        # PYTHON_ZEROCONF_GLOBAL_DONE_WAIT_TIME still throttles the loop.
+        if os.getenv('PYTHON_ZEROCONF_GLOBAL_DONE_WAIT_TIME'):
+
+            def done():
+                return self.zc.done
+
+        else:
+            done = self.zc._GLOBAL_DONE.is_set
+        while not done():
             with self.condition:
                 rs = self.readers.keys()
                 if len(rs) == 0:
@@ -1193,7 +1275,7 @@ class Engine(threading.Thread):
             if len(rs) != 0:
                 try:
                     rr, wr, er = select.select(rs, [], [], self.timeout)
-                    if not self.zc.done:
+                    if not done():
                         for socket_ in rr:
                             reader = self.readers.get(socket_)
                             if reader:
@@ -1202,7 +1284,7 @@ class Engine(threading.Thread):
                 except (select.error, socket.error) as e:
                     # If the socket was closed by another thread, during
                     # shutdown, ignore it and exit
-                    if e.args[0] != socket.EBADF or not self.zc.done:
+                    if e.args[0] != socket.EBADF or not done():
                         raise
 
     def add_reader(self, reader, socket_):
@@ -1235,7 +1317,21 @@ class Listener(QuietLogger):
         except Exception:
             self.log_exception_warning()
             return
+        self.handle_packet(data, addr, port)
 
+        if not _MSG_DONTWAIT:
+            return
+        # drain whatever else is already queued without going back to select
+        for i in xrange(_MAX_READS_PER_WAKEUP - 1):
+            try:
+                data, (addr, port) = socket_.recvfrom(_MAX_MSG_ABSOLUTE, _MSG_DONTWAIT)
+            except Exception as e:
+                if get_errno(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.log_exception_warning()
+                return
+            self.handle_packet(data, addr, port)
+
+    def handle_packet(self, data, addr, port):
         log.debug("Received from %r:%r: %r ", addr, port, data)
 
         self.data = data
@@ -1270,11 +1366,21 @@ class Reaper(threading.Thread):
         self.start()
 
     def run(self):
+        next_time = current_time_millis() + _REAPER_INTERVAL
         while True:
-            self.zc.wait(10 * 1000)
+            now = current_time_millis()
+            if next_time - now > _REAPER_INTERVAL:
+                # the clock stepped backwards, don't wait out the difference
+                next_time = now
+            if now < next_time:
+                self.zc.wait(min(next_time - now, _REAPER_INTERVAL))
             if self.zc.done:
                 return
             now = current_time_millis()
+            # every notify_all() wakes us up, only scan the cache when due
+            if now < next_time:
+                continue
+            next_time = now + _REAPER_INTERVAL
             for record in self.zc.cache.entries():
                 if record.is_expired(now):
                     self.zc.update_record(now, record)
@@ -1341,10 +1447,13 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
         self.daemon = True
         self.zc = zc
         self.type = type_
+        # the same PTR question is asked for as long as the browser runs
+        self.question = DNSQuestion(type_, _TYPE_PTR, _CLASS_IN)
         self.services = {}
         self.next_time = current_time_millis()
         self.delay = _BROWSER_TIME
-        self._handlers_to_call = []
+        # (name, state_change) pairs to fire from the browser thread
+        self._handlers_to_call = deque()
 
         self._service_state_changed = Signal()
 
@@ -1391,16 +1500,6 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
         if not record.name.endswith(self.type):
             return
 
-        def enqueue_callback(state_change, name):
-            self._handlers_to_call.append(
-                lambda zeroconf: self._service_state_changed.fire(
-                    zeroconf=zeroconf,
-                    service_type=self.type,
-                    name=name,
-                    state_change=state_change,
-                )
-            )
-
         if record.type == _TYPE_PTR:
             expired = record.is_expired(now)
             service_key = record.alias.lower()
@@ -1409,13 +1508,13 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
             except KeyError:
                 if not expired:
                     self.services[service_key] = record
-                    enqueue_callback(ServiceStateChange.Added, record.alias)
+                    self._handlers_to_call.append((record.alias, ServiceStateChange.Added))
             else:
                 if not expired:
                     old_record.reset_ttl(record)
                 else:
                     del self.services[service_key]
-                    enqueue_callback(ServiceStateChange.Removed, record.alias)
+                    self._handlers_to_call.append((record.alias, ServiceStateChange.Removed))
                     return
 
             expires = record.get_expiration_time(75)
@@ -1426,7 +1525,7 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
             assert isinstance(record, DNSText)
             expired = record.is_expired(now)
             if not expired:
-                enqueue_callback(ServiceStateChange.Updated, record.name)
+                self._handlers_to_call.append((record.name, ServiceStateChange.Updated))
 
     def cancel(self):
         self.done = True
@@ -1434,7 +1533,7 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
         self.join()
 
     def run(self):
-        self.zc.add_listener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+        self.zc.add_listener(self, self.question)
 
         while True:
             now = current_time_millis()
@@ -1445,7 +1544,7 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
             now = current_time_millis()
             if self.next_time <= now:
                 out = DNSOutgoing(_FLAGS_QR_QUERY)
-                out.add_question(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+                out.add_question(self.question)
                 for record in self.services.values():
                     if not record.is_stale(now):
                         out.add_answer_at_time(record, now)
@@ -1455,8 +1554,13 @@ class ServiceBrowser(RecordUpdateListener, threading.Thread):
                 self.delay = min(20 * 1000, self.delay * 2)
 
             if len(self._handlers_to_call) > 0 and not self.zc.done:
-                handler = self._handlers_to_call.pop(0)
-                handler(self.zc)
+                name, state_change = self._handlers_to_call.popleft()
+                self._service_state_changed.fire(
+                    zeroconf=self.zc,
+                    service_type=self.type,
+                    name=name,
+                    state_change=state_change,
+                )
 
 
 class ServiceInfo(object):
@@ -1510,7 +1614,6 @@ class ServiceInfo(object):
         if isinstance(properties, dict):
             self._properties = properties
             list_ = []
-            result = b""
             for key, value in iteritems(properties):
                 if isinstance(key, text_type):
                     key = key.encode("utf-8")
@@ -1528,10 +1631,10 @@ class ServiceInfo(object):
                         suffix = b"false"
                 else:
                     suffix = b""
-                list_.append(b"=".join((key, suffix)))
-            for item in list_:
-                result = b"".join((result, int2byte(len(item)), item))
-            self.text = result
+                item = b"=".join((key, suffix))
+                list_.append(int2byte(len(item)))
+                list_.append(item)
+            self.text = b"".join(list_)
         else:
             self.text = properties
 
@@ -1539,16 +1642,18 @@ class ServiceInfo(object):
         """Sets properties and text given a text field"""
         self.text = text
         result = {}
+        # indexing a bytearray gives ints on both Python 2 and 3
+        lengths = bytearray(text)
         end = len(text)
         index = 0
-        strs = []
         while index < end:
-            length = indexbytes(text, index)
+            length = lengths[index]
             index += 1
-            strs.append(text[index : index + length])
+            if not length:
+                continue
+            s = text[index : index + length]
             index += length
 
-        for s in strs:
             parts = s.split(b"=", 1)
             try:
                 key, value = parts
@@ -1617,6 +1722,8 @@ class ServiceInfo(object):
         if None not in (self.server, self.address, self.text):
             return True
 
+        question_srv = DNSQuestion(self.name, _TYPE_SRV, _CLASS_IN)
+        question_txt = DNSQuestion(self.name, _TYPE_TXT, _CLASS_IN)
         try:
             zc.add_listener(self, DNSQuestion(self.name, _TYPE_ANY, _CLASS_IN))
             while None in (self.server, self.address, self.text):
@@ -1624,22 +1731,24 @@ class ServiceInfo(object):
                     return False
                 if next_ <= now:
                     out = DNSOutgoing(_FLAGS_QR_QUERY)
-                    out.add_question(DNSQuestion(self.name, _TYPE_SRV, _CLASS_IN))
-                    out.add_answer_at_time(
-                        zc.cache.get_by_details(self.name, _TYPE_SRV, _CLASS_IN), now
-                    )
-
-                    out.add_question(DNSQuestion(self.name, _TYPE_TXT, _CLASS_IN))
-                    out.add_answer_at_time(
-                        zc.cache.get_by_details(self.name, _TYPE_TXT, _CLASS_IN), now
-                    )
+                    out.add_question(question_srv)
+                    out.add_question(question_txt)
+                    known_answers = [
+                        zc.cache.get_by_details(self.name, _TYPE_SRV, _CLASS_IN),
+                        zc.cache.get_by_details(self.name, _TYPE_TXT, _CLASS_IN),
+                    ]
 
                     if self.server is not None:
                         out.add_question(DNSQuestion(self.server, _TYPE_A, _CLASS_IN))
-                        out.add_answer_at_time(
-                            zc.cache.get_by_details(self.server, _TYPE_A, _CLASS_IN),
-                            now,
+                        known_answers.append(
+                            zc.cache.get_by_details(self.server, _TYPE_A, _CLASS_IN)
                         )
+
+                    # Only records with more than half their TTL left are
+                    # worth listing as known answers (RFC 6762, section 7.1)
+                    for record in known_answers:
+                        if record is not None and not record.is_stale(now):
+                            out.add_answer_at_time(record, now)
                     zc.send(out)
                     next_ = now + delay
                     delay *= 2
@@ -1679,6 +1788,42 @@ class ServiceInfo(object):
         )
 
 
+class _ServiceAnswers(object):
+
+    """The records answering queries about a registered service
+
+    They only depend on the ServiceInfo, so they are built once when the
+    service is registered or updated rather than for every query."""
+
+    __slots__ = ("pointer", "service", "text", "address")
+
+    def __init__(self, pointer, service, text, address):
+        self.pointer = pointer
+        self.service = service
+        self.text = text
+        self.address = address
+
+    @classmethod
+    def from_info(cls, info):
+        return cls(
+            DNSPointer(info.type, _TYPE_PTR, _CLASS_IN, info.ttl, info.name),
+            DNSService(
+                info.name,
+                _TYPE_SRV,
+                _CLASS_IN | _CLASS_UNIQUE,
+                info.ttl,
+                info.priority,
+                info.weight,
+                info.port,
+                info.server,
+            ),
+            DNSText(info.name, _TYPE_TXT, _CLASS_IN | _CLASS_UNIQUE, info.ttl, info.text),
+            DNSAddress(
+                info.server, _TYPE_A, _CLASS_IN | _CLASS_UNIQUE, info.ttl, info.address
+            ),
+        )
+
+
 class ZeroconfServiceTypes(object):
     """
     Return all of the advertised services on any local networks
@@ -1810,10 +1955,12 @@ class Zeroconf(QuietLogger):
         self.interfaces = []
         self.active_interfaces = []
         self._respond_sockets = {}
+        self._outgoing_ips = {}
 
         self.listeners = []
         self.browsers = {}
         self.services = {}
+        self._service_answers = {}
         self.servicetypes = {}
 
         self._add_interfaces(normalize_interface_choice(interfaces))
@@ -1875,10 +2022,15 @@ class Zeroconf(QuietLogger):
         """Registers service information to the network with a default TTL
         of 60 seconds.  Zeroconf will then respond to requests for
         information for that service.  The name of the service may be
-        changed if needed to make it unique on the network."""
+        changed if needed to make it unique on the network.
+
+        Answers to queries are built from info as it is at this point;
+        changes made to info afterwards need a call to update_service()
+        to be announced and answered with."""
         info.ttl = ttl
         self.check_service(info, allow_name_change)
         self.services[info.name.lower()] = info
+        self._service_answers[info.name.lower()] = _ServiceAnswers.from_info(info)
         if info.type in self.servicetypes:
             self.servicetypes[info.type] += 1
         else:
@@ -1889,12 +2041,17 @@ class Zeroconf(QuietLogger):
     def update_service(self, info, ttl=_DNS_TTL):
         """Registers service information to the network with a default TTL.
         Zeroconf will then respond to requests for information for that
-        service."""
+        service.
+
+        This is also how changes made to an already registered info are
+        picked up by the answers to queries."""
 
         if info.name.lower() not in self.services:
             raise AssertionError("Cannot update a service that doesn't exist")
 
+        info.ttl = ttl
         self.services[info.name.lower()] = info
+        self._service_answers[info.name.lower()] = _ServiceAnswers.from_info(info)
 
         self._broadcast_service(info, ttl=ttl)
 
@@ -1909,12 +2066,11 @@ class Zeroconf(QuietLogger):
         for i in interfaces:
             log.debug("Adding %r to multicast group", i)
             self.interfaces.append(i)
+            packed_ip = socket.inet_aton(i)
             try:
                 # attach listener socket to the interface
                 self._listen_socket.setsockopt(
-                    socket.IPPROTO_IP,
-                    socket.IP_ADD_MEMBERSHIP,
-                    socket.inet_aton(_MDNS_ADDR) + socket.inet_aton(i),
+                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, _MDNS_ADDR_BYTES + packed_ip
                 )
             except socket.error as e:
                 if get_errno(e) == errno.EADDRINUSE:
@@ -1935,10 +2091,13 @@ class Zeroconf(QuietLogger):
 
             respond_socket = new_socket()
             respond_socket.setsockopt(
-                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(i)
+                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, packed_ip
             )
 
             self._respond_sockets[i] = respond_socket
+            # remember the address we just bound to, so sending doesn't
+            # have to ask the socket for it every time
+            self._outgoing_ips[i] = packed_ip
             self.active_interfaces.append(i)
 
             # immediate broadcast to these interfaces for services already registered
@@ -1967,6 +2126,7 @@ class Zeroconf(QuietLogger):
             respond_socket = self._respond_sockets.pop(i, None)
             if respond_socket:
                 respond_socket.close()
+            packed_ip = self._outgoing_ips.pop(i)
 
             self.interfaces.remove(i)
             self.active_interfaces.remove(i)
@@ -1976,7 +2136,7 @@ class Zeroconf(QuietLogger):
                 self._listen_socket.setsockopt(
                     socket.IPPROTO_IP,
                     socket.IP_DROP_MEMBERSHIP,
-                    socket.inet_aton(_MDNS_ADDR) + socket.inet_aton(i),
+                    _MDNS_ADDR_BYTES + packed_ip,
                 )
             except socket.error as e:
                 # When we're removing, if the interface or bound address for it are not available, we can ignore it
@@ -2032,6 +2192,7 @@ class Zeroconf(QuietLogger):
         if interface is None:
             try:
                 del self.services[info.name.lower()]
+                del self._service_answers[info.name.lower()]
                 if self.servicetypes[info.type] > 1:
                     self.servicetypes[info.type] -= 1
                 else:
@@ -2199,13 +2360,12 @@ class Zeroconf(QuietLogger):
         now = current_time_millis()
         for record in msg.answers:
             expired = record.is_expired(now)
-            if record in self.cache.entries():
+            entry = self.cache.get(record)
+            if entry is not None:
                 if expired:
                     self.cache.remove(record)
                 else:
-                    entry = self.cache.get(record)
-                    if entry is not None:
-                        entry.reset_ttl(record)
+                    entry.reset_ttl(record)
             else:
                 self.cache.add(record)
                 if record.type == _TYPE_TXT:
@@ -2243,79 +2403,34 @@ class Zeroconf(QuietLogger):
                                 stype,
                             ),
                         )
-                for service in self.services.values():
-                    if question.name == service.type:
+                for answers in self._service_answers.values():
+                    if question.name == answers.pointer.name:
                         if out is None:
                             out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
-                        out.add_answer(
-                            msg,
-                            DNSPointer(
-                                service.type,
-                                _TYPE_PTR,
-                                _CLASS_IN,
-                                service.ttl,
-                                service.name,
-                            ),
-                        )
+                        out.add_answer(msg, answers.pointer)
             else:
                 try:
                     if out is None:
                         out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
 
+                    name = question.name.lower()
+
                     # Answer A record queries for any service addresses we know
                     if question.type in (_TYPE_A, _TYPE_ANY):
-                        for service in self.services.values():
-                            if service.server == question.name.lower():
-                                out.add_answer(
-                                    msg,
-                                    DNSAddress(
-                                        question.name,
-                                        _TYPE_A,
-                                        _CLASS_IN | _CLASS_UNIQUE,
-                                        service.ttl,
-                                        service.address,
-                                    ),
-                                )
-
-                    service = self.services.get(question.name.lower(), None)
-                    if not service:
+                        for answers in self._service_answers.values():
+                            if answers.address.name == name:
+                                out.add_answer(msg, answers.address)
+
+                    answers = self._service_answers.get(name, None)
+                    if not answers:
                         continue
 
                     if question.type in (_TYPE_SRV, _TYPE_ANY):
-                        out.add_answer(
-                            msg,
-                            DNSService(
-                                question.name,
-                                _TYPE_SRV,
-                                _CLASS_IN | _CLASS_UNIQUE,
-                                service.ttl,
-                                service.priority,
-                                service.weight,
-                                service.port,
-                                service.server,
-                            ),
-                        )
+                        out.add_answer(msg, answers.service)
                     if question.type in (_TYPE_TXT, _TYPE_ANY):
-                        out.add_answer(
-                            msg,
-                            DNSText(
-                                question.name,
-                                _TYPE_TXT,
-                                _CLASS_IN | _CLASS_UNIQUE,
-                                service.ttl,
-                                service.text,
-                            ),
-                        )
+                        out.add_answer(msg, answers.text)
                     if question.type == _TYPE_SRV:
-                        out.add_additional_answer(
-                            DNSAddress(
-                                service.server,
-                                _TYPE_A,
-                                _CLASS_IN | _CLASS_UNIQUE,
-                                service.ttl,
-                                service.address,
-                            )
-                        )
+                        out.add_additional_answer(answers.address)
                 except Exception:  # TODO stop catching all Exceptions
                     self.log_exception_warning()
 
@@ -2339,7 +2454,7 @@ class Zeroconf(QuietLogger):
             if interface is not None and interface != socket_interface:
                 continue
             try:
-                outgoing_ip = respond_socket.getsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, 4)
+                outgoing_ip = self._outgoing_ips[socket_interface]
                 socket_packet = packet.replace(
                     USE_IP_OF_OUTGOING_INTERFACE, outgoing_ip
                 )
@@ -2370,6 +2485,11 @@ class Zeroconf(QuietLogger):
 
             # shutdown recv socket and thread
             self.engine.del_reader(self._listen_socket)
+            try:
+                # wakes the engine up from select where the OS supports it
+                self._listen_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
             self._listen_socket.close()
             self.engine.join()
 